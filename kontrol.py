@@ -1,88 +1,49 @@
-import sqlite3
-import requests
-from bs4 import BeautifulSoup
-from datetime import datetime
-
-DB_FILE = "deprem.db"
-KOERI_URL = "http://www.koeri.boun.edu.tr/scripts/lst6.asp"
-
-def fetch_koeri_lines():
-    r = requests.get(KOERI_URL, timeout=30)
-    r.encoding = "utf-8"
-    soup = BeautifulSoup(r.text, "html.parser")
-    pre = soup.find("pre")
-    if not pre:
-        return []
-    lines = [ln.rstrip("\n") for ln in pre.get_text("\n").splitlines()]
-    out = []
-    for ln in lines:
-        s = ln.strip()
-        if not s:
-            continue
-        if s.startswith("Tarih") or "SON DEPREMLER" in s or s.startswith("----") or s.startswith(".."):
-            continue
-        parts = s.split()
-        if len(parts) < 10:
-            continue
-        # parts[0]=YYYY.MM.DD, parts[1]=HH:MM:SS
-        out.append(parts)
-    return out
-
-def koeri_max_day_and_counts(parts_list):
-    # KOERI'deki en yeni günü bul (hardcode yok)
-    max_dt = None
-    for p in parts_list:
-        try:
-            dt = datetime.strptime(f"{p[0]} {p[1]}", "%Y.%m.%d %H:%M:%S")
-            if (max_dt is None) or (dt > max_dt):
-                max_dt = dt
-        except:
-            pass
-
-    if not max_dt:
+import heapq
+from datetime import date, timedelta
+
+# KOERI indirme/parse ve DB ayarları main.py ile ortak: iki ayrı parser
+# aynı sayfayı farklı yorumlamasın.
+from main import DB_PATH as DB_FILE, KOERI_URL, connect_db, parse_koeri, _table_exists
+
+def koeri_max_day_and_counts(rows):
+    # rows: parse_koeri() çıktısı -> (event_time_iso, lat, lon, mag, depth, loc)
+    if not rows:
         return None, 0, 0, []
 
-    target_day = max_dt.strftime("%Y-%m-%d")
+    # KOERI'deki en yeni günü bul (hardcode yok); ISO string zaten sıralanabilir
+    target_day = max(r[0] for r in rows)[:10]
+
     # O güne ait satır sayısı
-    day_count = 0
-    for p in parts_list:
-        if p[0].replace(".", "-") == target_day:
-            day_count += 1
+    day_count = sum(1 for r in rows if r[0][:10] == target_day)
 
     # KOERI en son 5 satır (ekranda görmek için)
-    last5 = []
-    # KOERI listesi zaten genelde yeniler üstte; yine de dt’ye göre sıralayalım:
-    def to_dt(p):
-        return datetime.strptime(f"{p[0]} {p[1]}", "%Y.%m.%d %H:%M:%S")
-    parts_sorted = sorted(parts_list, key=to_dt, reverse=True)
-    for p in parts_sorted[:5]:
-        # Ekrana daha okunur bas
-        last5.append(" ".join(p))
+    newest5 = heapq.nlargest(5, rows, key=lambda r: r[0])
+    last5 = [" ".join("-" if v is None else str(v) for v in r) for r in newest5]
 
-    return target_day, len(parts_list), day_count, last5
+    return target_day, len(rows), day_count, last5
 
 def db_counts(target_day):
-    con = sqlite3.connect(DB_FILE)
+    con = connect_db(DB_FILE)
     cur = con.cursor()
 
     # tablo var mı?
-    tables = cur.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
-    tables = [t[0] for t in tables]
-    if "earthquakes" not in tables:
+    if not _table_exists(cur, "earthquakes"):
         con.close()
-        return 0, None, []
+        return 0, None, 0, []
 
     total = cur.execute("SELECT COUNT(*) FROM earthquakes").fetchone()[0]
     max_time = cur.execute("SELECT MAX(event_time) FROM earthquakes").fetchone()[0]
 
-    # event_time "YYYY-MM-DDTHH:MM:SS"
+    # event_time "YYYY-MM-DDTHH:MM:SS+00:00"; substr() index'i kullanamaz,
+    # [gün, ertesi gün) aralığı olarak sorgulayınca index üzerinden sayılır
+    next_day = (date.fromisoformat(target_day) + timedelta(days=1)).isoformat()
     day_count = cur.execute(
-        "SELECT COUNT(*) FROM earthquakes WHERE substr(event_time,1,10)=?",
-        (target_day,)
+        "SELECT COUNT(*) FROM earthquakes WHERE event_time >= ? AND event_time < ?",
+        (target_day, next_day)
     ).fetchone()[0]
 
     last5 = cur.execute("""
-        SELECT event_time, latitude, longitude, depth, magnitude, location
+        SELECT event_time, latitude, longitude, depth_km, magnitude, location
         FROM earthquakes
         ORDER BY event_time DESC
         LIMIT 5
@@ -96,12 +57,16 @@ def main():
     print(f"DB: {DB_FILE}")
     print(f"KOERI: {KOERI_URL}\n")
 
-    parts_list = fetch_koeri_lines()
-    if not parts_list:
-        print("KOERI parse edilemedi (<pre> yok ya da format değişti).")
+    try:
+        rows = parse_koeri()
+    except RuntimeError as e:
+        print(e)
+        return
+    if not rows:
+        print("KOERI parse edilemedi (format değişmiş olabilir).")
         return
 
-    target_day, koeri_total, koeri_day_count, koeri_last5 = koeri_max_day_and_counts(parts_list)
+    target_day, koeri_total, koeri_day_count, koeri_last5 = koeri_max_day_and_counts(rows)
     if not target_day:
         print("KOERI'den tarih çıkarılamadı.")
         return
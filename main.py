@@ -1,10 +1,9 @@
 import os
 import re
+import codecs
 import math
 import sqlite3
-from datetime import datetime, timezone
-import requests
-from bs4 import BeautifulSoup
+from datetime import datetime
 
 # ===================== AYARLAR =====================
 KOERI_URL = os.getenv("KOERI_URL", "http://www.koeri.boun.edu.tr/scripts/lst6.asp")
@@ -41,14 +40,80 @@ KONAK_LON = float(os.getenv("KONAK_LON", "27.1287"))
 KONAK_RADIUS_KM = float(os.getenv("KONAK_RADIUS_KM", "100"))
 KONAK_LIST_N = int(os.getenv("KONAK_LIST_N", "2"))
 
+# KOERI listesi satırı: TARİH SAAT ENLEM BOYLAM DERİNLİK MD ML Mw YER... NİTELİK
+KOERI_LINE_RE = re.compile(
+    r"^[ \t]*(\d{4})\.(\d{2})\.(\d{2})[ \t]+(\d{2}:\d{2}:\d{2})"
+    r"[ \t]+(-?\d+(?:\.\d+)?)[ \t]+(-?\d+(?:\.\d+)?)"
+    r"[ \t]+(\S+)[ \t]+(\S+)[ \t]+(\S+)[ \t]+(\S+)"
+    r"[ \t]*([^\r\n]*)$",
+)
+_PRE_RE = re.compile(rb"<pre[^>]*>", re.I)
+_PRE_END_RE = re.compile(rb"</pre\s*>", re.I)
+_CHARSET_RE = re.compile(rb"charset=[\"']?([\w-]+)", re.I)
+
 # ===================== YARDIMCILAR =====================
-def haversine_km(lat1, lon1, lat2, lon2):
-    r = 6371.0
-    p1, p2 = math.radians(lat1), math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dl = math.radians(lon2 - lon1)
-    a = math.sin(dphi / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
-    return 2 * r * math.asin(math.sqrt(a))
+_SESSION = None
+
+def _http():
+    """
+    KOERI ve Telegram için ortak keep-alive oturumu. requests ilk ağ
+    çağrısında yüklenir; main.py'den yalnızca yardımcı alan modüller ödemez.
+    """
+    global _SESSION
+    if _SESSION is None:
+        import requests
+        _SESSION = requests.Session()
+        _SESSION.headers.update({"User-Agent": "bandirma-deprem/1.0"})
+    return _SESSION
+
+def bbox_deg(lat0, radius_km):
+    """
+    (lat0, ?) merkezli radius_km çemberini kapsayan en küçük enlem/boylam
+    yarı-genişlikleri (derece). Kutu dışındaki nokta çemberin de dışındadır;
+    haversine'den önce ucuz bir eleme için.
+    """
+    ang = radius_km / 6371.0
+    dlat = math.degrees(ang)
+    c = math.cos(math.radians(lat0))
+    if c <= math.sin(ang):
+        return dlat, 180.0
+    return dlat, math.degrees(math.asin(math.sin(ang) / c))
+
+def make_center(lat0, lon0, radius_km):
+    """
+    Sabit bir merkez için çalışma boyunca değişmeyen değerler bir kez hesaplanır:
+    radyan enlem, cos(enlem) ve kutu yarı-genişlikleri.
+    """
+    p1 = math.radians(lat0)
+    dlat, dlon = bbox_deg(lat0, radius_km)
+    return {
+        "lat": lat0, "lon": lon0, "radius": radius_km,
+        "p1": p1, "cos_p1": math.cos(p1), "dlat": dlat, "dlon": dlon,
+    }
+
+def dist_from_center(c, lat, lon):
+    # Haversine mesafesi (km); merkez sabitleri make_center'da bir kez hesaplanır
+    p2 = math.radians(lat)
+    dphi = p2 - c["p1"]
+    dl = math.radians(lon - c["lon"])
+    a = math.sin(dphi / 2) ** 2 + c["cos_p1"] * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * 6371.0 * math.asin(math.sqrt(a))
+
+def _to_float(x):
+    # KOERI boş magnitüd sütunlarını "-.-" yazar; her satırda ValueError
+    # fırlatıp yakalamak yerine ucuz bir karakter kontrolüyle ele.
+    if not x or x == "-.-" or x == "--" or x[0] not in "0123456789-+.":
+        return None
+    try:
+        return float(x)
+    except ValueError:
+        return None
+
+def _codec_or_utf8(name: str) -> str:
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return "utf-8"
 
 def _table_exists(cur, name: str) -> bool:
     cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (name,))
@@ -62,6 +127,15 @@ def _index_exists(cur, name: str) -> bool:
     cur.execute("SELECT name FROM sqlite_master WHERE type='index' AND name=?", (name,))
     return cur.fetchone() is not None
 
+def _meta_get(cur, k: str):
+    cur.execute("SELECT v FROM meta WHERE k=?", (k,))
+    r = cur.fetchone()
+    return r[0] if r else None
+
+def _meta_set(cur, k: str, v):
+    if v:
+        cur.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (k, v))
+
 def _dedupe_before_unique(cur):
     # Klasik yöntem: en küçük rowid kalsın, diğer mükerrerleri sil.
     # depth_km NULL olabilir; COALESCE ile 0.0 yapıp grupluyoruz.
@@ -80,6 +154,19 @@ def _dedupe_before_unique(cur):
         )
     """)
 
+def connect_db(path: str = DB_PATH):
+    """
+    Çalışma boyunca açık kalacak bağlantı: WAL + daha az fsync,
+    geçici tablolar bellekte, sayfa önbelleği ve mmap sorgular arası sıcak kalsın.
+    """
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    return conn
+
 def ensure_db(conn):
     """
     Amaç:
@@ -87,6 +174,8 @@ def ensure_db(conn):
     2) Eski DB'lerde eksik kolon varsa migrate et (depth_km)
     3) UNIQUE INDEX oluşturmadan önce mükerrerleri temizle (Actions hatasını çözer)
     4) UNIQUE INDEX'i güvenle oluştur
+    5) event_time/magnitude sorguları için index
+    6) KOERI ETag/Last-Modified için küçük meta tablosu
     """
     cur = conn.cursor()
 
@@ -134,6 +223,15 @@ def ensure_db(conn):
             """)
             conn.commit()
 
+    # 5) Zaman + magnitüd index'i: "son N kayıt" ve pencere sorguları tabloya
+    #    inmeden index üzerinden (covering) cevaplanır.
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_time_mag ON earthquakes(event_time, magnitude)")
+    conn.commit()
+
+    # 6) Meta tablosu (koşullu GET için son ETag / Last-Modified)
+    cur.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT)")
+    conn.commit()
+
 def trim_db(conn):
     cur = conn.cursor()
     cur.execute("SELECT COUNT(*) FROM earthquakes")
@@ -150,74 +248,128 @@ def trim_db(conn):
     """, (n - MAX_ROWS,))
     conn.commit()
 
-def parse_koeri():
-    html = requests.get(KOERI_URL, timeout=30).content
-    soup = BeautifulSoup(html, "html.parser")
-    pre = soup.find("pre")
-    if not pre:
-        raise RuntimeError("KOERI sayfasında <pre> bulunamadı (format değişmiş olabilir).")
-
-    lines = [l.strip() for l in pre.get_text("\n").splitlines() if l.strip()]
-
-    rows = []
-    for ln in lines:
-        if ln.startswith("Tarih") or ln.startswith("----"):
-            continue
-
-        p = re.split(r"\s+", ln)
-        if len(p) < 8:
-            continue
-
-        # Örnek beklenen: YYYY.MM.DD HH:MM:SS LAT LON DEPTH MAG ... LOCATION...
-        try:
-            dt = datetime.strptime(p[0] + " " + p[1], "%Y.%m.%d %H:%M:%S").replace(tzinfo=timezone.utc)
-            lat = float(p[2])
-            lon = float(p[3])
-        except Exception:
-            continue
-
-        # depth bazen kayabilir; güvenli parse
-        depth = None
-        try:
-            depth = float(p[4])
-        except Exception:
-            depth = None
-
-        # Magnitude: 5-8 arası ilk float bul
-        mag = None
-        idx = None
-        for i in range(5, min(10, len(p))):
-            try:
-                mag = float(p[i])
-                idx = i
+def _parse_koeri_line(line):
+    """KOERI <pre> satırı -> (event_time, lat, lon, mag, depth, loc) ya da None."""
+    m = KOERI_LINE_RE.match(line)
+    if not m:
+        return None
+    y, mo, d, t, lat, lon, depth, md, ml, mw, rest = m.groups()
+
+    # Tarih sabit genişlikte; datetime kurup isoformat'a geri çevirmek yerine
+    # doğrudan DB'deki biçime ("YYYY-MM-DDTHH:MM:SS+00:00") diliyoruz.
+    event_time = f"{y}-{mo}-{d}T{t}+00:00"
+    # Enlem/boylam regex'te sayısal olarak eşlendi; float() hata veremez
+    lat = float(lat)
+    lon = float(lon)
+
+    # depth bazen kayabilir; güvenli parse
+    depth = _to_float(depth)
+
+    # Magnitude: MD / ML / Mw içinden ilk geçerli değer
+    mags = (md, ml, mw)
+    for i, tok in enumerate(mags):
+        mag = _to_float(tok)
+        if mag is not None:
+            break
+    else:
+        return None
+
+    # Lokasyon, seçilen magnitüdden sonraki tüm sütunlar (eski split tabanlı
+    # parser ile birebir aynı; UNIQUE anahtarın parçası olduğu için değişmemeli).
+    loc = " ".join([*mags[i + 1:], *rest.split()]) or "-"
+
+    return (event_time, lat, lon, mag, depth, loc)
+
+def parse_koeri(conn=None):
+    # Koşullu GET: sayfa değişmediyse KOERI 304 döner, parse/insert tamamen atlanır.
+    # conn verilmezse (ör. kontrol.py) sayfa her zaman tam indirilir.
+    cur = conn.cursor() if conn is not None else None
+    headers = {}
+    if cur is not None:
+        etag = _meta_get(cur, "koeri_etag")
+        last_mod = _meta_get(cur, "koeri_last_modified")
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_mod:
+            headers["If-Modified-Since"] = last_mod
+
+    # Gövde akış halinde okunur: satırlar ağdan geldikçe parse edilir,
+    # </pre> ya da 500 satırdan sonrası hiç indirilmez.
+    with _http().get(KOERI_URL, headers=headers, timeout=30, stream=True) as r:
+        if r.status_code == 304:
+            print("KOERI değişmemiş (304), parse atlanıyor.")
+            return []
+        r.raise_for_status()
+
+        # Sayfa tek bir <pre> içinde düz metin; DOM kurmaya gerek yok.
+        # Karakter setini BS4'ün yaptığı gibi <meta charset> üzerinden bul
+        # (<head> içinde, <pre>'den önce gelir).
+        charset = "utf-8"
+        in_pre = False
+        rows = []
+        for raw in r.iter_lines(chunk_size=16384):
+            if not in_pre:
+                m = _CHARSET_RE.search(raw)
+                if m:
+                    charset = _codec_or_utf8(m.group(1).decode("ascii"))
+                m = _PRE_RE.search(raw)
+                if not m:
+                    continue
+                in_pre = True
+                raw = raw[m.end():]
+
+            end = _PRE_END_RE.search(raw)
+            if end:
+                raw = raw[:end.start()]
+
+            row = _parse_koeri_line(raw.decode(charset, errors="replace"))
+            if row is not None:
+                rows.append(row)
+                if len(rows) >= 500:
+                    break
+            if end:
                 break
-            except Exception:
-                pass
-        if mag is None:
-            continue
 
-        loc = " ".join(p[idx + 1:]).strip() if idx is not None else "-"
-        if not loc:
-            loc = "-"
+        if not in_pre:
+            raise RuntimeError("KOERI sayfasında <pre> bulunamadı (format değişmiş olabilir).")
 
-        rows.append((dt.isoformat(), lat, lon, mag, depth, loc))
-        if len(rows) >= 500:
-            break
+        # Yeni doğrulayıcılar upsert() commit'i ile birlikte yazılır;
+        # insert başarısız olursa bir sonraki çalışma sayfayı yeniden indirir.
+        if cur is not None:
+            _meta_set(cur, "koeri_etag", r.headers.get("ETag"))
+            _meta_set(cur, "koeri_last_modified", r.headers.get("Last-Modified"))
 
     return rows
 
 def upsert(conn, rows):
+    if not rows:
+        # parse_koeri'nin yazdığı ETag/Last-Modified satır olmasa da kalıcı olsun
+        conn.commit()
+        return 0
     cur = conn.cursor()
-    added = 0
-    for r in rows:
-        # depth None olabilir; DB'ye NULL gitsin
-        cur.execute("INSERT OR IGNORE INTO earthquakes VALUES (?, ?, ?, ?, ?, ?)", r)
-        if cur.rowcount == 1:
-            added += 1
+
+    # Sayfadaki ~500 satırın neredeyse tamamı önceki çalışmalardan DB'de.
+    # Sayfanın kapsadığı zaman aralığını bir kez okuyup set ile eleyelim;
+    # INSERT OR IGNORE yalnızca gerçekten yeni olabilecek satırlara gitsin.
+    cur.execute("""
+        SELECT event_time, latitude, longitude, magnitude, depth_km, location
+        FROM earthquakes
+        WHERE event_time >= ?
+    """, (min(r[0] for r in rows),))
+    seen = set(cur.fetchall())
+
+    new_rows = [r for r in rows if r not in seen]
+
+    # Tek transaction + executemany: satır başına rowcount kontrolü yerine
+    # eklenen sayıyı total_changes farkından al; tek commit = tek fsync.
+    # depth None olabilir; DB'ye NULL gitsin
+    before = conn.total_changes
+    cur.executemany("INSERT OR IGNORE INTO earthquakes VALUES (?, ?, ?, ?, ?, ?)", new_rows)
+    added = conn.total_changes - before
     conn.commit()
     return added
 
-def last_n_near(conn, lat0, lon0, radius, n):
+def last_n_near(conn, center, n):
     cur = conn.cursor()
     cur.execute("""
         SELECT event_time, latitude, longitude, depth_km, magnitude, location
@@ -225,9 +377,14 @@ def last_n_near(conn, lat0, lon0, radius, n):
         ORDER BY event_time DESC
         LIMIT 800
     """)
+    lat0, lon0, radius = center["lat"], center["lon"], center["radius"]
+    dlat, dlon = center["dlat"], center["dlon"]
+    # fetchall() yerine cursor'dan akıt: n kayıt bulununca kalan satırlar hiç okunmaz
     out = []
-    for et, lat, lon, depth, mag, loc in cur.fetchall():
-        dist = haversine_km(lat0, lon0, lat, lon)
+    for et, lat, lon, depth, mag, loc in cur:
+        if abs(lat - lat0) > dlat or abs(lon - lon0) > dlon:
+            continue
+        dist = dist_from_center(center, lat, lon)
         if dist <= radius:
             out.append((et, depth, mag, loc, dist))
         if len(out) >= n:
@@ -246,9 +403,10 @@ def compute_alarm_label(max_mag, orange_thr, red_thr):
 def fmt_events(events):
     lines = []
     for et, depth, mag, loc, dist in events:
-        try:
-            t = datetime.fromisoformat(et.replace("Z", "+00:00")).strftime("%d.%m %H:%M")
-        except Exception:
+        # et: "YYYY-MM-DDTHH:MM:SS+00:00" -> "DD.MM HH:MM" (datetime kurmadan)
+        if len(et) >= 16 and et[4] == "-" and et[7] == "-" and et[10] == "T":
+            t = f"{et[8:10]}.{et[5:7]} {et[11:16]}"
+        else:
             t = et[:16]
 
         d = 0.0 if depth is None else float(depth)
@@ -264,7 +422,7 @@ def send_telegram(text):
 
     url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
     try:
-        r = requests.post(
+        r = _http().post(
             url,
             data={"chat_id": TELEGRAM_CHAT_ID, "text": text, "parse_mode": "Markdown"},
             timeout=20,
@@ -277,57 +435,67 @@ def send_telegram(text):
         print("Telegram gönderim exception:", e)
         return False
 
+# Merkez sabitleri modül yüklenirken bir kez
+BANDIRMA = make_center(BANDIRMA_LAT, BANDIRMA_LON, BANDIRMA_RADIUS_KM)
+BURSA = make_center(BURSA_LAT, BURSA_LON, BURSA_RADIUS_KM)
+KONAK = make_center(KONAK_LAT, KONAK_LON, KONAK_RADIUS_KM)
+
+# Mesaj sabitleri: (başlık, merkez, listelenecek kayıt sayısı)
+REPORT_TITLE = "📍 *Deprem Alarm Bot*"
+NO_EVENTS = ("• Kayıt yok",)
+CENTERS = (
+    ("🟦 *Bandırma*", BANDIRMA, BANDIRMA_LIST_N),
+    ("🟨 *Bursa*", BURSA, BURSA_LIST_N),
+    ("🟪 *İzmir Konak*", KONAK, KONAK_LIST_N),
+)
+
 # ===================== MAIN =====================
 def main():
-    conn = sqlite3.connect(DB_PATH)
+    conn = connect_db(DB_PATH)
+    try:
+        run(conn)
+    finally:
+        # WAL dosyası kapanışta ana DB'ye checkpoint edilir; Actions yalnızca
+        # deprem.db'yi commit'lediği için bağlantı her durumda kapanmalı.
+        conn.close()
+
+def run(conn):
     ensure_db(conn)
 
-    rows = parse_koeri()
+    rows = parse_koeri(conn)
     added = upsert(conn, rows)
     trim_db(conn)
 
     # Türkiye alarmı (son TR_WINDOW_N kayıt)
     cur = conn.cursor()
     cur.execute("""
-        SELECT magnitude FROM earthquakes
-        ORDER BY event_time DESC
-        LIMIT ?
+        SELECT COALESCE(MAX(magnitude), 0.0) FROM (
+            SELECT magnitude FROM earthquakes
+            ORDER BY event_time DESC
+            LIMIT ?
+        )
     """, (TR_WINDOW_N,))
-    mags = [r[0] for r in cur.fetchall()]
-    tr_max = max(mags) if mags else 0.0
+    tr_max = cur.fetchone()[0]
     tr_alarm = compute_alarm_label(tr_max, TR_ORANGE_MW, TR_RED_MW)
 
-    # Merkezler
-    bandirma = last_n_near(conn, BANDIRMA_LAT, BANDIRMA_LON, BANDIRMA_RADIUS_KM, BANDIRMA_LIST_N)
-    bursa = last_n_near(conn, BURSA_LAT, BURSA_LON, BURSA_RADIUS_KM, BURSA_LIST_N)
-    konak = last_n_near(conn, KONAK_LAT, KONAK_LON, KONAK_RADIUS_KM, KONAK_LIST_N)
-
-    bandirma_max = max((e[2] for e in bandirma), default=0.0)
-    bursa_max = max((e[2] for e in bursa), default=0.0)
-    konak_max = max((e[2] for e in konak), default=0.0)
-
-    bandirma_alarm = compute_alarm_label(bandirma_max, ORANGE_MW, RED_MW)
-    bursa_alarm = compute_alarm_label(bursa_max, ORANGE_MW, RED_MW)
-    konak_alarm = compute_alarm_label(konak_max, ORANGE_MW, RED_MW)
-
     print(f"KOERI parse: {min(500, len(rows))} | Yeni eklenen: {added}")
 
-    msg = []
-    msg.append("📍 *Deprem Alarm Bot*")
-    msg.append(datetime.now().strftime("🕒 %d.%m.%Y %H:%M"))
-    msg.append(f"🇹🇷 Türkiye Alarm: {tr_alarm} (max Mw={tr_max:.1f})")
-    msg.append("")
+    msg = [
+        REPORT_TITLE,
+        datetime.now().strftime("🕒 %d.%m.%Y %H:%M"),
+        f"🇹🇷 Türkiye Alarm: {tr_alarm} (max Mw={tr_max:.1f})",
+    ]
+    alarms = [tr_alarm]
 
-    msg.append(f"🟦 *Bandırma* Alarm: {bandirma_alarm}")
-    msg.extend(fmt_events(bandirma) if bandirma else ["• Kayıt yok"])
-    msg.append("")
-
-    msg.append(f"🟨 *Bursa* Alarm: {bursa_alarm}")
-    msg.extend(fmt_events(bursa) if bursa else ["• Kayıt yok"])
-    msg.append("")
+    # Merkezler
+    for label, center, n in CENTERS:
+        events = last_n_near(conn, center, n)
+        alarm = compute_alarm_label(max((e[2] for e in events), default=0.0), ORANGE_MW, RED_MW)
+        alarms.append(alarm)
 
-    msg.append(f"🟪 *İzmir Konak* Alarm: {konak_alarm}")
-    msg.extend(fmt_events(konak) if konak else ["• Kayıt yok"])
+        msg.append("")
+        msg.append(f"{label} Alarm: {alarm}")
+        msg.extend(fmt_events(events) if events else NO_EVENTS)
 
     # Telegram gönderim kuralı:
     # - FORCE_TELEGRAM=1 ise her zaman
@@ -335,16 +503,11 @@ def main():
     send = (
         FORCE_TELEGRAM
         or added > 0
-        or ("*ORANGE*" in tr_alarm) or ("*RED*" in tr_alarm)
-        or ("*ORANGE*" in bandirma_alarm) or ("*RED*" in bandirma_alarm)
-        or ("*ORANGE*" in bursa_alarm) or ("*RED*" in bursa_alarm)
-        or ("*ORANGE*" in konak_alarm) or ("*RED*" in konak_alarm)
+        or any(("*ORANGE*" in a) or ("*RED*" in a) for a in alarms)
     )
 
     if send:
         send_telegram("\n".join(msg))
 
-    conn.close()
-
 if __name__ == "__main__":
     main()
@@ -1,12 +1,40 @@
 # turkiye_alarm.py
 import os
+import math
+import atexit
 import sqlite3
 from datetime import datetime, timezone, timedelta
-from math import radians, sin, cos, asin, sqrt
+
+import numpy as np
+
+# Mesafe hesabı, bağlantı ayarları ve şema main.py ile ortak
+# (earthquakes: depth_km, event_id/source yok)
+from main import bbox_deg, connect_db
 
 # -----------------------------
 # Helpers
 # -----------------------------
+_CONNS = {}
+
+def _get_conn(db_file: str) -> sqlite3.Connection:
+    """
+    db_file başına tek, süreç boyunca açık bağlantı (WAL + PRAGMA'lar bir kez).
+    Her sorguda connect/close yapıp sayfa önbelleğini soğutmayalım.
+    """
+    con = _CONNS.get(db_file)
+    if con is None:
+        con = connect_db(db_file)
+        con.row_factory = sqlite3.Row
+        _CONNS[db_file] = con
+    return con
+
+def _close_conns():
+    for con in _CONNS.values():
+        con.close()
+    _CONNS.clear()
+
+atexit.register(_close_conns)
+
 def _to_dt_utc(s: str) -> datetime:
     """
     DB'deki event_time ISO string -> timezone-aware UTC datetime
@@ -22,63 +50,87 @@ def _to_dt_utc(s: str) -> datetime:
         dt = dt.replace(tzinfo=timezone.utc)
     return dt.astimezone(timezone.utc)
 
-def haversine_km(lat1, lon1, lat2, lon2) -> float:
-    R = 6371.0
-    dlat = radians(lat2 - lat1)
-    dlon = radians(lon2 - lon1)
-    a = sin(dlat / 2) ** 2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon / 2) ** 2
-    return 2 * R * asin(sqrt(a))
+def haversine_km_vec(lats, lons, center_lat: float, center_lon: float):
+    """
+    main.dist_from_center'ın NumPy karşılığı: tek merkezden tüm satırlara mesafe (km).
+    lats/lons: float64 ndarray
+    """
+    # Merkez terimleri skaler (math); NumPy yalnızca satır dizileri üzerinde çalışır
+    p1 = math.radians(center_lat)
+    cos_p1 = math.cos(p1)
+    p2 = np.radians(lats)
+    dphi = p2 - p1
+    dl = np.radians(lons - center_lon)
+    a = np.sin(dphi / 2) ** 2 + cos_p1 * np.cos(p2) * np.sin(dl / 2) ** 2
+    return 2 * 6371.0 * np.arcsin(np.sqrt(a))
+
+def within_radius(cols, center_lat, center_lon, radius_km: float):
+    """
+    cols: fetch_columns() çıktısı
+    Returns: (mask, dist_km) -> yarıçap içindeki satırlar için bool maske ve
+    mesafeler (kutu dışında kalanlar için inf)
+    """
+    lats, lons = cols["latitude"], cols["longitude"]
+
+    # Önce ucuz kutu elemesi; trigonometri yalnızca kutu içindekilere
+    dlat, dlon = bbox_deg(center_lat, radius_km)
+    idx = np.flatnonzero((np.abs(lats - center_lat) <= dlat) & (np.abs(lons - center_lon) <= dlon))
+    dist = np.full(lats.shape, np.inf)
+    dist[idx] = haversine_km_vec(lats[idx], lons[idx], center_lat, center_lon)
+    return dist <= radius_km, dist
 
-def within_radius(rows, center_lat, center_lon, radius_km: float):
+def _since_iso(now_utc: datetime, delta: timedelta) -> str:
     """
-    rows: list of dict {event_time, latitude, longitude, depth, magnitude, location, source}
+    DB'deki event_time biçiminde ('YYYY-MM-DDTHH:MM:SS+00:00') eşik.
+    ISO string'ler sıralanabilir; satır başına datetime parse etmeden karşılaştırılır.
     """
-    out = []
-    for r in rows:
-        d = haversine_km(center_lat, center_lon, float(r["latitude"]), float(r["longitude"]))
-        if d <= radius_km:
-            rr = dict(r)
-            rr["dist_km"] = d
-            out.append(rr)
-    return out
+    return (now_utc - delta).isoformat(timespec="seconds")
 
-def fetch_rows(db_file: str, since_dt_utc: datetime):
+def fetch_columns(db_file: str, since_iso: str, min_mag: float = None):
     """
-    since_dt_utc: timezone-aware UTC
+    since_iso sonrasındaki (ve verilirse magnitude >= min_mag olan) kayıtları
+    sütun dizileri (SoA) olarak döndürür:
+    {event_time: str[], latitude/longitude/depth_km/magnitude: float64[], location: list}
+    Pencere/yarıçap/eşik filtreleri bu diziler üzerinde maske olarak çalışır.
     """
-    since_iso = since_dt_utc.astimezone(timezone.utc).isoformat(timespec="seconds")
-    con = sqlite3.connect(db_file)
-    con.row_factory = sqlite3.Row
-    cur = con.cursor()
-    cur.execute(
-        """
-        SELECT event_id, event_time, latitude, longitude, depth, magnitude, location, source
+    cur = _get_conn(db_file).cursor()
+    # Sütunlara dökülecek satırlar için sqlite3.Row nesnesi gereksiz; düz tuple yeter
+    cur.row_factory = None
+    # event_time aralığı index üzerinden taranır, magnitude koşulu da aynı
+    # index kaydında elenir; eşiği geçemeyen satırlar Python'a hiç gelmez
+    sql = """
+        SELECT event_time, latitude, longitude, depth_km, magnitude, location
         FROM earthquakes
         WHERE event_time >= ?
-        ORDER BY event_time DESC
-        """,
-        (since_iso,),
-    )
-    rows = [dict(r) for r in cur.fetchall()]
-    con.close()
-    return rows
+        """
+    params = [since_iso]
+    if min_mag is not None:
+        sql += " AND magnitude >= ?"
+        params.append(min_mag)
+    cur.execute(sql + " ORDER BY event_time DESC", params)
+    rows = cur.fetchall()
+    t, lat, lon, depth, mag, loc = zip(*rows) if rows else ((),) * 6
+    return {
+        "event_time": np.array(t, dtype=str),
+        "latitude": np.array(lat, dtype=np.float64),
+        "longitude": np.array(lon, dtype=np.float64),
+        "depth_km": np.array([np.nan if d is None else d for d in depth], dtype=np.float64),
+        "magnitude": np.array(mag, dtype=np.float64),
+        "location": list(loc),
+    }
 
 def get_last_n_rows(db_file: str, n: int = 5):
-    con = sqlite3.connect(db_file)
-    con.row_factory = sqlite3.Row
-    cur = con.cursor()
+    cur = _get_conn(db_file).cursor()
     cur.execute(
         """
-        SELECT event_id, event_time, latitude, longitude, depth, magnitude, location, source
+        SELECT event_time, latitude, longitude, depth_km, magnitude, location
         FROM earthquakes
         ORDER BY event_time DESC
         LIMIT ?
         """,
         (int(n),),
     )
-    rows = [dict(r) for r in cur.fetchall()]
-    con.close()
-    return rows
+    return [dict(r) for r in cur.fetchall()]
 
 def format_last5(rows_last5):
     lines = []
@@ -86,12 +138,11 @@ def format_last5(rows_last5):
     for r in rows_last5:
         dt = _to_dt_utc(r["event_time"]).astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
         mag = r.get("magnitude", "")
-        dep = r.get("depth", "")
+        dep = r.get("depth_km", "")
         loc = (r.get("location") or "").strip()
         lat = r.get("latitude", "")
         lon = r.get("longitude", "")
-        src = (r.get("source") or "").strip()
-        lines.append(f"- {dt} | M{mag} | {dep}km | {loc} | ({lat},{lon}) | {src}")
+        lines.append(f"- {dt} | M{mag} | {dep}km | {loc} | ({lat},{lon})")
     return "\n".join(lines)
 
 # -----------------------------
@@ -101,21 +152,28 @@ def build_report(db_file: str, center_lat: float, center_lon: float, radius_km:
     """
     Returns: (has_alarm: bool, message: str, last5_block: str)
     """
+    # Pencere eşikleri bir kez, doğrudan string olarak hesaplanır
     now_utc = datetime.now(timezone.utc)
+    since_24h = _since_iso(now_utc, timedelta(days=1))
+    since_7d = _since_iso(now_utc, timedelta(days=7))
 
-    rows_24h = fetch_rows(db_file, now_utc - timedelta(days=1))
-    rows_7d  = fetch_rows(db_file, now_utc - timedelta(days=7))
-    rows_30d = fetch_rows(db_file, now_utc - timedelta(days=30))
-
-    in_24h = within_radius(rows_24h, center_lat, center_lon, radius_km)
-    in_7d  = within_radius(rows_7d,  center_lat, center_lon, radius_km)
-    in_30d = within_radius(rows_30d, center_lat, center_lon, radius_km)
+    # En geniş kullanılan pencere (7 gün) bir kez okunur; 24 saat bunun alt kümesi.
+    # Eşiklerin en küçüğü (5.0) altındaki olaylar hiçbir karara girmez, SQL'de elenir
+    cols = fetch_columns(db_file, since_7d, min_mag=5.0)
+    near, dist = within_radius(cols, center_lat, center_lon, radius_km)
+    mag = cols["magnitude"]
+    in_24h = near & (cols["event_time"] >= since_24h)
+    in_7d = near
 
     # Basit ama stabil eşikler (istersen sonra geliştiririz):
     # - KIRMIZI: 70 km içinde son 24 saatte Mw>=5.5
     # - TURUNCU: 70 km içinde son 7 günde Mw>=5.0  (kırmızı yoksa)
-    red = any(float(r["magnitude"]) >= 5.5 for r in in_24h)
-    orange = (not red) and any(float(r["magnitude"]) >= 5.0 for r in in_7d)
+    # "eşiği aşan var mı" = pencere maksimumu eşiği aşıyor mu: her pencere tek bir
+    # max indirgemesi, eşikler skaler karşılaştırma
+    max24 = float(mag[in_24h].max(initial=-np.inf))
+    max7 = float(mag[in_7d].max(initial=-np.inf))
+    red = max24 >= 5.5
+    orange = (not red) and max7 >= 5.0
 
     last5 = get_last_n_rows(db_file, 5)
     last5_block = format_last5(last5)
@@ -130,13 +188,20 @@ def build_report(db_file: str, center_lat: float, center_lon: float, radius_km:
     msg.append("")
 
     # Alarmı tetikleyen en büyük olayı öne çıkar
-    candidates = in_24h if red else in_7d
-    candidates_sorted = sorted(candidates, key=lambda x: float(x["magnitude"]), reverse=True)
-    top = candidates_sorted[0]
+    candidates = np.flatnonzero(in_24h if red else in_7d)
+    i = candidates[np.argmax(mag[candidates])]
+    depth = cols["depth_km"][i]
+    top = {
+        "event_time": str(cols["event_time"][i]),
+        "magnitude": float(mag[i]),
+        "depth_km": None if np.isnan(depth) else float(depth),
+        "location": cols["location"][i],
+        "dist_km": float(dist[i]),
+    }
     dt = _to_dt_utc(top["event_time"]).astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
     msg.append("⭐ Tetikleyen olay:")
     msg.append(
-        f"- {dt} | M{top['magnitude']} | {top['depth']}km | {top['location']} | "
+        f"- {dt} | M{top['magnitude']} | {top['depth_km']}km | {top['location']} | "
         f"{top.get('dist_km',0):.1f} km"
     )
     msg.append("")